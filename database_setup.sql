@@ -21,28 +21,40 @@ CREATE TABLE printers (
     INDEX idx_name (name)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- =====================================================
+-- TABLA DE USUARIOS
+-- =====================================================
+CREATE TABLE users (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(50) NOT NULL UNIQUE COMMENT 'Usuario de CUPS (ej: ph03272)',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 -- =====================================================
 -- TABLA DE TRABAJOS DE IMPRESIÓN
 -- =====================================================
 CREATE TABLE print_jobs (
     id INT AUTO_INCREMENT PRIMARY KEY,
     job_id VARCHAR(50) NOT NULL COMMENT 'ID del trabajo de CUPS',
-    user_id VARCHAR(50) NOT NULL COMMENT 'Usuario que imprimió (ej: ph03272)',
+    user_id INT NOT NULL COMMENT 'ID del usuario que imprimió',
     printer_id INT NOT NULL COMMENT 'ID de la impresora',
     document_name VARCHAR(255) COMMENT 'Nombre del documento impreso',
     pages INT NOT NULL DEFAULT 1 COMMENT 'Número de páginas',
     copies INT NOT NULL DEFAULT 1 COMMENT 'Número de copias',
     status ENUM('completed', 'pending', 'cancelled', 'error') DEFAULT 'completed' COMMENT 'Estado del trabajo',
     timestamp TIMESTAMP NOT NULL COMMENT 'Fecha y hora de la impresión',
+    source ENUM('page_log', 'notifier', 'journal') NOT NULL DEFAULT 'page_log' COMMENT 'Origen del registro',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     FOREIGN KEY (printer_id) REFERENCES printers(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id),
     
     INDEX idx_timestamp (timestamp),
     INDEX idx_user_id (user_id),
     INDEX idx_printer_id (printer_id),
     INDEX idx_status (status),
-    INDEX idx_job_id (job_id)
+    UNIQUE INDEX idx_job_id (job_id),
+    INDEX idx_source_timestamp (source, timestamp)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- =====================================================
@@ -54,11 +66,16 @@ INSERT INTO printers (name, ip_address, location, model) VALUES
 ('PHARI074', '10.10.3.110', 'Oficina Principal', 'HP LaserJet Pro M404n'),
 ('PHARI075', '10.10.3.111', 'Sala de Reuniones', 'HP LaserJet Pro M404n');
 
+-- Insertar 2 usuarios de ejemplo
+INSERT INTO users (username) VALUES
+('ph03272'),
+('ph03150');
+
 -- Insertar 3 trabajos de impresión de ejemplo
 INSERT INTO print_jobs (job_id, user_id, printer_id, document_name, pages, copies, status, timestamp) VALUES
-('001', 'ph03272', 1, 'Reporte_Mensual.pdf', 45, 1, 'completed', NOW() - INTERVAL 2 HOUR),
-('002', 'ph03150', 1, 'Factura_001.pdf', 2, 1, 'completed', NOW() - INTERVAL 3 HOUR),
-('003', 'ph03272', 2, 'Presentacion.pptx', 15, 1, 'completed', NOW() - INTERVAL 4 HOUR);
+('001', 1, 1, 'Reporte_Mensual.pdf', 45, 1, 'completed', NOW() - INTERVAL 2 HOUR),
+('002', 2, 1, 'Factura_001.pdf', 2, 1, 'completed', NOW() - INTERVAL 3 HOUR),
+('003', 1, 2, 'Presentacion.pptx', 15, 1, 'completed', NOW() - INTERVAL 4 HOUR);
 
 -- =====================================================
 -- VISTA PARA ESTADÍSTICAS DEL DASHBOARD
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Notificador de CUPS para el Print Server
+Recibe los eventos de trabajos de CUPS y los reenvía al procesador residente
+
+INSTALACIÓN:
+- Copiar a /usr/lib/cups/notifier/printtrack (el nombre del archivo es el esquema de la URI)
+- Suscribir con printtrack-subscription.test (notify-recipient-uri printtrack://)
+
+CUPS ejecuta el notificador como "printtrack <recipient-uri> <user-data>" y le
+escribe por stdin un mensaje IPP por evento. Cada evento se decodifica y se envía
+como JSON por el socket Unix del procesador (procesar_logs.py --daemon).
+
+PRUEBAS:
+- python3 notificador_cups.py --dump < eventos_grabados.ipp  (muestra los eventos en JSON)
+"""
+
+import json
+import logging
+import socket
+import struct
+import sys
+from typing import Dict
+from urllib.parse import urlsplit
+
+# CUPS guarda en su error_log lo que el notificador escribe por stderr con prefijo de nivel
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s: %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+
+NOTIFY_SOCKET = "/run/print-track/ingest.sock"  # Socket del procesador residente
+
+# Tags IPP (RFC 8010)
+IPP_TAG_END = 0x03
+IPP_TAG_INTEGER = 0x21
+IPP_TAG_BOOLEAN = 0x22
+IPP_TAG_ENUM = 0x23
+IPP_TAG_DATE = 0x31
+IPP_TAG_TEXTLANG = 0x35
+IPP_TAG_NAMELANG = 0x36
+
+
+def read_exact(stream, size: int) -> bytes:
+    """Leer exactamente size bytes del stream"""
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("Mensaje IPP incompleto")
+    return data
+
+
+def decode_ipp_value(tag: int, value: bytes):
+    """Convertir un valor IPP a un tipo serializable en JSON"""
+    if tag < 0x20:
+        # Valores fuera de banda (unknown, no-value, ...)
+        return None
+    if tag in (IPP_TAG_INTEGER, IPP_TAG_ENUM) and len(value) == 4:
+        return struct.unpack('>i', value)[0]
+    if tag == IPP_TAG_BOOLEAN and len(value) == 1:
+        return value != b'\x00'
+    if tag == IPP_TAG_DATE and len(value) == 11:
+        year, month, day, hour, minute, second, _, sign, tz_hour, tz_min = struct.unpack('>HBBBBBBcBB', value)
+        return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}{sign.decode()}{tz_hour:02d}{tz_min:02d}"
+    if tag in (IPP_TAG_TEXTLANG, IPP_TAG_NAMELANG) and len(value) >= 4:
+        lang_len = struct.unpack('>H', value[:2])[0]
+        text_len = struct.unpack('>H', value[2 + lang_len:4 + lang_len])[0]
+        return value[4 + lang_len:4 + lang_len + text_len].decode('utf-8', errors='replace')
+    if 0x40 <= tag <= 0x4F:
+        # text, name, keyword, uri, charset, naturalLanguage, mimeMediaType
+        return value.decode('utf-8', errors='replace')
+    return value.hex()
+
+
+def read_ipp_message(stream) -> Dict:
+    """Leer un mensaje IPP del stream y devolver sus atributos; None al llegar al final"""
+    header = stream.read(8)
+    if not header:
+        return None
+    if len(header) < 8:
+        raise EOFError("Encabezado IPP incompleto")
+
+    attributes = {}
+    name = None
+    while True:
+        tag = read_exact(stream, 1)[0]
+        if tag == IPP_TAG_END:
+            break
+        if tag < 0x10:
+            # Comienzo de un nuevo grupo de atributos
+            name = None
+            continue
+
+        name_length = struct.unpack('>H', read_exact(stream, 2))[0]
+        attr_name = read_exact(stream, name_length).decode('utf-8', errors='replace')
+        value_length = struct.unpack('>H', read_exact(stream, 2))[0]
+        value = decode_ipp_value(tag, read_exact(stream, value_length))
+
+        if attr_name:
+            name = attr_name
+            attributes[name] = value
+        elif name:
+            # Valor adicional del atributo anterior (1setOf)
+            if not isinstance(attributes[name], list):
+                attributes[name] = [attributes[name]]
+            attributes[name].append(value)
+
+    return attributes
+
+
+def send_event(socket_path: str, event: Dict) -> bool:
+    """Enviar un evento al procesador residente como un datagrama JSON"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(json.dumps(event).encode('utf-8'), socket_path)
+        return True
+    except OSError as e:
+        logging.error(f"No se pudo enviar el evento del trabajo {event.get('notify-job-id')} a {socket_path}: {e}")
+        return False
+
+
+def main():
+    """Función principal - Reenvía eventos hasta que CUPS cierra stdin"""
+    dump = '--dump' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--dump']
+
+    # printtrack:// usa el socket por defecto, printtrack:///ruta/al.sock uno propio
+    socket_path = NOTIFY_SOCKET
+    if args:
+        uri_path = urlsplit(args[0]).path
+        if uri_path and uri_path != '/':
+            socket_path = uri_path
+
+    stream = sys.stdin.buffer
+    while True:
+        try:
+            event = read_ipp_message(stream)
+        except EOFError as e:
+            logging.error(f"Evento IPP truncado: {e}")
+            break
+
+        if event is None:
+            break
+
+        if dump:
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+        else:
+            send_event(socket_path, event)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ Lee los logs y los mete en la BD MariaDB
 CONFIGURADO PARA FUNCIONAR COMO EN  SERVER RHEL:
 - Usa archivo de log legacy: /var/log/cups/page_log
 - Extrae páginas y nombres de archivo directamente de los archivos de control de CUPS
+- Con --daemon registra los trabajos al terminar, con los eventos de notificador_cups.py
 """
 
 import os
@@ -14,7 +15,15 @@ import logging
 import glob
 import re
 import subprocess
-from datetime import datetime
+import time
+import hashlib
+import json
+import mmap
+import socket
+import grp
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from typing import Set, List, Dict
 import sys
 
@@ -30,6 +39,25 @@ logging.basicConfig(
 # Configuración de archivos
 LOG_FILE = "/var/log/cups/page_log"  # Archivo de logs de CUPS (legacy)
 CUPS_SPOOL_DIR = "/var/spool/cups"  # Directorio de archivos de control de CUPS
+CUPSD_CONF = "/etc/cups/cupsd.conf"  # Configuración de CUPS (de donde se lee PageLogFormat)
+PAGE_LOG_FORMAT = None  # Formato del page_log; None = leer PageLogFormat de CUPSD_CONF
+DEFAULT_PAGE_LOG_FORMAT = "%p %u %j %T %P %C %{job-billing} %{job-originating-host-name} %{job-name} %{media} %{sides}"
+CUPS_MONTHS = {m: i for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+CHECKPOINT_FILE = "/var/lib/print-track/page_log.checkpoint"  # Posición ya procesada del page_log
+SCHEMA_CHECK_FILE = "/var/lib/print-track/schema_checked.json"  # Base de datos cuyo esquema ya se verificó
+DOCUMENT_CACHE_FILE = "/var/lib/print-track/document_cache.json"  # Páginas/formato/título por huella del documento
+DOCUMENT_CACHE_MAX_ENTRIES = 2048  # Documentos distintos que se recuerdan (se descarta el menos usado)
+FINGERPRINT_BLOCK_SIZE = 65536  # Bytes del inicio y del final que entran en la huella
+USER_MIGRATION_BATCH_SIZE = 5000  # Filas de print_jobs por lote al migrar user_id
+MAX_JOB_INSERT_ATTEMPTS = 5  # Ejecuciones con un trabajo fallando (y otros insertándose bien) antes de descartarlo
+JOB_COALESCE_WINDOW = 60  # Segundos sin líneas nuevas para dar por terminado un trabajo
+MAX_JOBS_IN_FLIGHT = 256  # Máximo de trabajos abiertos en el agrupador del page_log
+
+# Configuración del modo residente (eventos del notificador de CUPS)
+NOTIFY_SOCKET = "/run/print-track/ingest.sock"  # Socket donde escribe notificador_cups.py
+NOTIFY_SOCKET_GROUP = "lp"  # Grupo con el que corre el notificador dentro de cupsd
+NOTIFY_MAX_EVENT_SIZE = 65536  # Tamaño máximo de un evento en bytes
+JOB_STATE_STATUS = {9: 'completed', 7: 'cancelled', 8: 'error'}  # job-state IPP -> status de print_jobs
 USE_JOURNAL = False  # Usar archivo de log legacy. 
 
 # Configuración de la base de datos
@@ -41,58 +69,136 @@ DB_CONFIG = {
     'charset': 'utf8mb4',
     'autocommit': True
 }
+DB_IDLE_PING_SECONDS = 60  # Solo se verifica la conexión después de este tiempo sin uso
+DB_RECONNECT_ERRORS = {2006}  # Conexión perdida antes de enviar la consulta (siempre se reintenta una vez)
+DB_LOST_DURING_QUERY_ERRORS = {2013, 2055}  # Conexión perdida con la consulta enviada (solo se reintenta si es idempotente)
 
 class PrintServerDB:
+    # Consultas fijas del procesador (se reutilizan sobre un único cursor)
+    SQL_SELECT_JOB_IDS = "SELECT job_id FROM print_jobs"
+    # Solo filas leídas del page_log: las del notificador llevan la hora de llegada del evento
+    SQL_LAST_TIMESTAMP = "SELECT MAX(timestamp) FROM print_jobs WHERE source = 'page_log'"
+    SQL_UPDATE_DOCUMENT_NAME = "UPDATE print_jobs SET document_name = %s WHERE job_id = %s"
+    SQL_UPDATE_JOB_PAGES = "UPDATE print_jobs SET pages = %s WHERE job_id = %s"
+    # LAST_INSERT_ID(id) devuelve el id existente sin otra consulta
+    SQL_UPSERT_PRINTER = """
+        INSERT INTO printers (name, ip_address, location) 
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE 
+            ip_address = VALUES(ip_address),
+            location = VALUES(location),
+            updated_at = CURRENT_TIMESTAMP,
+            id = LAST_INSERT_ID(id)
+    """
+    SQL_UPSERT_USER = """
+        INSERT INTO users (username) VALUES (%s)
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+    """
+    # job_id es único: si otro proceso (timer o modo residente) ya lo registró, no se duplica
+    SQL_INSERT_JOB = """
+        INSERT INTO print_jobs 
+        (job_id, user_id, printer_id, document_name, pages, copies, status, timestamp, source)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+    """
+    SQL_JOB_ID_UNIQUE = """
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'print_jobs'
+            AND INDEX_NAME = 'idx_job_id' AND NON_UNIQUE = 0
+    """
+    SQL_USER_ID_TYPE = """
+        SELECT DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'print_jobs' AND COLUMN_NAME = 'user_id'
+    """
+    SQL_JOB_SOURCE_COLUMN = """
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'print_jobs' AND COLUMN_NAME = 'source'
+    """
+
     def __init__(self, config: Dict):
         self.config = config
         self.connection = None
+        self.cursor = None
+        self.last_used = 0.0
+        # Caché en memoria de claves: nombre -> id
+        self.printer_ids = {}
+        self.user_ids = {}
         self.connect()
 
     def connect(self):
         """Establecer conexión con la base de datos"""
         try:
             self.connection = pymysql.connect(**self.config)
+            self.cursor = self.connection.cursor()
+            self.last_used = time.monotonic()
             logging.info("Conexión a MySQL establecida correctamente")
         except pymysql.Error as err:
             logging.error(f"Error conectando a MySQL: {err}")
             sys.exit(1)
 
+    def reconnect(self):
+        """Reabrir la conexión; el cursor persistente sigue asociado al mismo objeto"""
+        self.connection.ping(reconnect=True)
+        self.last_used = time.monotonic()
+
     def ensure_connection(self):
-        """Asegurar que la conexión esté activa"""
+        """Asegurar que la conexión esté activa (solo se verifica tras un período inactivo)"""
+        if time.monotonic() - self.last_used < DB_IDLE_PING_SECONDS:
+            return
         try:
-            self.connection.ping(reconnect=True)
-        except:
+            self.reconnect()
+        except pymysql.Error:
             self.connect()
 
+    def execute(self, query: str, params=None, idempotent: bool = True):
+        """Ejecutar una consulta en el cursor persistente; si se cortó la conexión, reconectar y reintentar una vez"""
+        self.ensure_connection()
+        try:
+            self.cursor.execute(query, params)
+        except (pymysql.OperationalError, pymysql.InterfaceError) as err:
+            if isinstance(err, pymysql.OperationalError):
+                code = err.args[0] if err.args else None
+                # Con la consulta ya enviada el servidor pudo haberla aplicado: solo repetir si es inocuo
+                if code not in DB_RECONNECT_ERRORS and not (idempotent and code in DB_LOST_DURING_QUERY_ERRORS):
+                    raise
+            logging.warning(f"Conexión a MySQL perdida ({err}), reconectando...")
+            self.reconnect()
+            self.cursor.execute(query, params)
+        
+        self.last_used = time.monotonic()
+        return self.cursor
+
     def get_processed_jobs(self) -> Set[str]:
         """Obtener trabajos ya procesados desde la base de datos"""
         try:
-            self.ensure_connection()
-            cursor = self.connection.cursor()
-            
-            cursor.execute("SELECT job_id FROM print_jobs")
-            results = cursor.fetchall()
+            results = self.execute(self.SQL_SELECT_JOB_IDS).fetchall()
             
             # Crear set de trabajos procesados
             processed = set()
             for (job_id,) in results:
                 processed.add(job_id)
             
-            cursor.close()
             return processed
             
         except pymysql.Error as err:
             logging.error(f"Error obteniendo trabajos procesados: {err}")
             return set()
 
+    def get_last_job_timestamp(self):
+        """Obtener el timestamp más reciente de los trabajos leídos del page_log"""
+        try:
+            result = self.execute(self.SQL_LAST_TIMESTAMP).fetchone()
+            
+            return result[0] if result else None
+            
+        except pymysql.Error as err:
+            logging.error(f"Error obteniendo último timestamp registrado: {err}")
+            return None
+
     def update_document_name(self, job_id: str, document_name: str):
         """Actualizar el nombre del documento para un trabajo existente"""
         try:
-            self.ensure_connection()
-            cursor = self.connection.cursor()
-            
-            query = "UPDATE print_jobs SET document_name = %s WHERE job_id = %s"
-            cursor.execute(query, (document_name, job_id))
+            cursor = self.execute(self.SQL_UPDATE_DOCUMENT_NAME, (document_name, job_id))
             
             if cursor.rowcount > 0:
                 logging.info(f"Nombre de documento actualizado para trabajo {job_id}: {document_name}")
@@ -103,18 +209,11 @@ class PrintServerDB:
         except pymysql.Error as err:
             logging.error(f"Error actualizando nombre de documento: {err}")
             return False
-        finally:
-            if cursor:
-                cursor.close()
 
     def update_job_pages(self, job_id: str, pages: int):
         """Actualizar el número de páginas para un trabajo existente"""
         try:
-            self.ensure_connection()
-            cursor = self.connection.cursor()
-            
-            query = "UPDATE print_jobs SET pages = %s WHERE job_id = %s"
-            cursor.execute(query, (pages, job_id))
+            cursor = self.execute(self.SQL_UPDATE_JOB_PAGES, (pages, job_id))
             
             if cursor.rowcount > 0:
                 logging.info(f"Páginas actualizadas para trabajo {job_id}: {pages}")
@@ -125,75 +224,219 @@ class PrintServerDB:
         except pymysql.Error as err:
             logging.error(f"Error actualizando páginas: {err}")
             return False
-        except pymysql.Error as err:
-            logging.error(f"Error actualizando nombre de documento para {job_id}: {err}")
-            return False
-        finally:
-            if cursor:
-                cursor.close()
 
     def insert_printer(self, name: str, ip_address: str = None, location: str = None):
-        """Insertar o actualizar impresora"""
+        """Insertar o actualizar impresora; devuelve su id"""
         try:
-            self.ensure_connection()
-            cursor = self.connection.cursor()
-            
             # Si no tenemos IP, usar un placeholder
             if not ip_address:
                 ip_address = "10.10.3.171"  # IP por defecto
             
-            query = """
-                INSERT INTO printers (name, ip_address, location) 
-                VALUES (%s, %s, %s)
-                ON DUPLICATE KEY UPDATE 
-                    ip_address = VALUES(ip_address),
-                    location = VALUES(location),
-                    updated_at = CURRENT_TIMESTAMP
-            """
-            cursor.execute(query, (name, ip_address, location))
-            
-            cursor.close()
+            cursor = self.execute(self.SQL_UPSERT_PRINTER, (name, ip_address, location))
+            
             logging.debug(f"Impresora {name} registrada/actualizada")
+            return cursor.lastrowid
             
         except pymysql.Error as err:
             logging.error(f"Error insertando impresora {name}: {err}")
+            return None
 
-    def insert_print_job(self, job_data: Dict):
-        """Insertar trabajo de impresión"""
+    def get_printer_id(self, name: str):
+        """Obtener el id de una impresora, registrándola si es nueva"""
+        if name in self.printer_ids:
+            return self.printer_ids[name]
+        
+        printer_id = self.insert_printer(name)
+        if not printer_id:
+            logging.error(f"Impresora {name} no encontrada después de insertar")
+            return None
+        
+        self.printer_ids[name] = printer_id
+        return printer_id
+
+    def get_user_id(self, username: str):
+        """Obtener el id de un usuario, registrándolo si es nuevo"""
+        if username in self.user_ids:
+            return self.user_ids[username]
+        
         try:
-            self.ensure_connection()
-            cursor = self.connection.cursor()
+            user_id = self.execute(self.SQL_UPSERT_USER, (username,)).lastrowid
             
-            # Primero asegurar que la impresora existe
-            self.insert_printer(job_data['printer'])
+            self.user_ids[username] = user_id
+            return user_id
             
-            # Obtener printer_id
-            cursor.execute("SELECT id FROM printers WHERE name = %s", (job_data['printer'],))
-            result = cursor.fetchone()
-            if not result:
-                logging.error(f"Impresora {job_data['printer']} no encontrada después de insertar")
+        except pymysql.Error as err:
+            logging.error(f"Error obteniendo id de usuario {username}: {err}")
+            return None
+
+    def user_keys_migrated(self) -> bool:
+        """Verificar si print_jobs.user_id ya es la clave entera de users"""
+        try:
+            result = self.execute(self.SQL_USER_ID_TYPE).fetchone()
+            
+            return bool(result) and result[0].lower() == 'int'
+            
+        except pymysql.Error as err:
+            logging.error(f"Error verificando esquema de print_jobs: {err}")
+            return False
+
+    def migrate_user_keys(self, batch_size: int = USER_MIGRATION_BATCH_SIZE) -> bool:
+        """Migrar print_jobs.user_id de texto a clave entera de la tabla users, por lotes"""
+        if self.user_keys_migrated():
+            logging.info("print_jobs.user_id ya usa la tabla users, no hay nada que migrar")
+            return True
+        
+        try:
+            self.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    username VARCHAR(50) NOT NULL UNIQUE COMMENT 'Usuario de CUPS (ej: ph03272)',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """)
+            
+            # Columna temporal con la clave entera (se puede retomar si se interrumpe)
+            cursor = self.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'print_jobs' AND COLUMN_NAME = 'user_key'
+            """)
+            if cursor.fetchone()[0] == 0:
+                self.execute("ALTER TABLE print_jobs ADD COLUMN user_key INT NULL AFTER user_id", idempotent=False)
+            
+            cursor = self.execute("INSERT IGNORE INTO users (username) SELECT DISTINCT user_id FROM print_jobs")
+            logging.info(f"Usuarios registrados en la tabla users: {cursor.rowcount} nuevos")
+            
+            cursor = self.execute("SELECT MIN(id), MAX(id) FROM print_jobs")
+            min_id, max_id = cursor.fetchone()
+            
+            converted = 0
+            if min_id is not None:
+                for start in range(min_id, max_id + 1, batch_size):
+                    cursor = self.execute("""
+                        UPDATE print_jobs pj
+                        JOIN users u ON u.username = pj.user_id
+                        SET pj.user_key = u.id
+                        WHERE pj.id BETWEEN %s AND %s AND pj.user_key IS NULL
+                    """, (start, start + batch_size - 1))
+                    converted += cursor.rowcount
+                    logging.info(f"Migrados {converted} trabajos (hasta id {min(start + batch_size - 1, max_id)} de {max_id})...")
+            
+            cursor = self.execute("SELECT COUNT(*) FROM print_jobs WHERE user_key IS NULL")
+            pending = cursor.fetchone()[0]
+            if pending:
+                logging.error(f"Quedaron {pending} trabajos sin usuario asignado, no se completa la migración")
                 return False
             
-            printer_id = result[0]
+            # Reemplazar la columna de texto por la clave entera
+            self.execute("""
+                ALTER TABLE print_jobs
+                    DROP INDEX idx_user_id,
+                    DROP COLUMN user_id,
+                    CHANGE COLUMN user_key user_id INT NOT NULL COMMENT 'ID del usuario que imprimió',
+                    ADD INDEX idx_user_id (user_id),
+                    ADD FOREIGN KEY (user_id) REFERENCES users(id)
+            """, idempotent=False)
+            
+            logging.info(f"Migración completada: {converted} trabajos convertidos a clave de usuario")
+            return True
+            
+        except pymysql.Error as err:
+            logging.error(f"Error migrando usuarios de print_jobs: {err}")
+            return False
+
+    def job_ids_unique(self) -> bool:
+        """Verificar si print_jobs.job_id ya tiene índice único"""
+        try:
+            return self.execute(self.SQL_JOB_ID_UNIQUE).fetchone()[0] > 0
+            
+        except pymysql.Error as err:
+            logging.error(f"Error verificando índice de job_id: {err}")
+            return False
+
+    def migrate_unique_job_ids(self) -> bool:
+        """Eliminar trabajos repetidos (se conserva el primero) y hacer único print_jobs.job_id"""
+        if self.job_ids_unique():
+            logging.info("print_jobs.job_id ya es único, no hay nada que migrar")
+            return True
+        
+        try:
+            cursor = self.execute("""
+                DELETE pj FROM print_jobs pj
+                JOIN print_jobs first ON first.job_id = pj.job_id AND first.id < pj.id
+            """)
+            logging.info(f"Trabajos repetidos eliminados: {cursor.rowcount}")
+            
+            self.execute("""
+                ALTER TABLE print_jobs
+                    DROP INDEX idx_job_id,
+                    ADD UNIQUE INDEX idx_job_id (job_id)
+            """, idempotent=False)
+            
+            logging.info("Migración completada: print_jobs.job_id es único")
+            return True
+            
+        except pymysql.Error as err:
+            logging.error(f"Error haciendo único print_jobs.job_id: {err}")
+            return False
+
+    def job_source_tracked(self) -> bool:
+        """Verificar si print_jobs ya tiene la columna source"""
+        try:
+            return self.execute(self.SQL_JOB_SOURCE_COLUMN).fetchone()[0] > 0
             
-            # Insertar trabajo de impresión
-            query = """
-                INSERT INTO print_jobs 
-                (job_id, user_id, printer_id, document_name, pages, copies, status, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (
+        except pymysql.Error as err:
+            logging.error(f"Error verificando columna source de print_jobs: {err}")
+            return False
+
+    def migrate_job_source(self) -> bool:
+        """Agregar print_jobs.source; las filas existentes quedan como leídas del page_log"""
+        if self.job_source_tracked():
+            logging.info("print_jobs.source ya existe, no hay nada que migrar")
+            return True
+        
+        try:
+            self.execute("""
+                ALTER TABLE print_jobs
+                    ADD COLUMN source ENUM('page_log', 'notifier', 'journal') NOT NULL DEFAULT 'page_log'
+                        COMMENT 'Origen del registro' AFTER timestamp,
+                    ADD INDEX idx_source_timestamp (source, timestamp)
+            """, idempotent=False)
+            
+            logging.info("Migración completada: print_jobs.source agregada")
+            return True
+            
+        except pymysql.Error as err:
+            logging.error(f"Error agregando print_jobs.source: {err}")
+            return False
+
+    def insert_print_job(self, job_data: Dict):
+        """Insertar trabajo de impresión (True si se insertó, None si ya estaba registrado, False si falló)"""
+        try:
+            printer_id = self.get_printer_id(job_data['printer'])
+            if printer_id is None:
+                return False
+            
+            user_id = self.get_user_id(job_data['user'])
+            if user_id is None:
+                return False
+            
+            # Insertar trabajo de impresión (repetirlo es inocuo: job_id es único)
+            cursor = self.execute(self.SQL_INSERT_JOB, (
                 job_data['job_id'],
-                job_data['user'],
+                user_id,
                 printer_id,
                 job_data['document'],
                 job_data['pages'],
                 job_data['copies'],
                 job_data['status'],
-                job_data['timestamp']
+                job_data['timestamp'],
+                job_data['source']
             ))
             
-            cursor.close()
+            # ON DUPLICATE KEY UPDATE id = id no modifica la fila: rowcount 0 si ya existía
+            if cursor.rowcount == 0:
+                return None
+            
             logging.info(f"Trabajo de impresión registrado: {job_data['user']} -> {job_data['printer']} ({job_data['pages']} páginas)")
             return True
             
@@ -204,13 +447,29 @@ class PrintServerDB:
 class CUPSControlFileParser:
     """Parser para archivos de control de CUPS"""
     
+    @staticmethod
+    def normalize_document_name(name: str) -> str:
+        """Limpiar un nombre de documento igual que los extraídos del archivo de control"""
+        name = re.sub(r'[^\w\s\-\.\(\)]', '', name)
+        return re.sub(r'\s+', ' ', name).strip()
+    
     @staticmethod
     def extract_job_info(control_file_path: str) -> Dict:
         """Extraer información de un archivo de control de CUPS (método legacy)"""
         try:
             with open(control_file_path, 'rb') as f:
-                content = f.read().decode('utf-8', errors='ignore')
-            return CUPSControlFileParser.extract_job_info_from_content(content, control_file_path)
+                content_bytes = f.read()
+            content = content_bytes.decode('utf-8', errors='ignore')
+            job_info = CUPSControlFileParser.extract_job_info_from_content(content, control_file_path)
+            
+            # copies es un entero IPP binario: tag 0x21, nombre de 6 bytes, valor de 4 bytes
+            copies_match = re.search(rb'\x21\x00\x06copies\x00\x04(.{4})', content_bytes, re.DOTALL)
+            if copies_match:
+                copies = int.from_bytes(copies_match.group(1), 'big', signed=True)
+                if copies > 0:
+                    job_info['copies'] = copies
+            
+            return job_info
         except Exception as e:
             logging.warning(f"Error parseando archivo de control {control_file_path}: {e}")
             return {}
@@ -326,11 +585,325 @@ class CUPSControlFileParser:
             logging.warning(f"Error parseando contenido del archivo de control: {e}")
             return {}
 
+def parse_cups_date(text: str):
+    """Parsear una fecha de CUPS "27/Aug/2025:13:30:28 -0300" (la zona horaria se ignora)"""
+    # Formato de ancho fijo: más rápido que strptime en el bucle de lectura
+    try:
+        return datetime(int(text[7:11]), CUPS_MONTHS[text[3:6]], int(text[0:2]),
+                        int(text[12:14]), int(text[15:17]), int(text[18:20]))
+    except (KeyError, ValueError):
+        return None
+
+class PageLogFormatParser:
+    """Parser del page_log generado una sola vez a partir del PageLogFormat de cupsd.conf"""
+    
+    # Directivas de PageLogFormat -> (campo, patrón)
+    DIRECTIVES = {
+        'p': ('printer', r'\S+'),
+        'u': ('user', r'\S+'),
+        'j': ('job_id', r'\d+'),
+        'T': ('date', r'\[[^\]]*\]'),
+        'P': ('page', r'\S+'),
+        'C': ('copies', r'\S+'),
+    }
+    # Atributos que CUPS escribe sin comillas y pueden tener espacios
+    FREE_TEXT_ATTRIBUTES = {'job-name'}
+    
+    def __init__(self, log_format: str):
+        self.log_format = log_format
+        self.attributes = {}  # nombre de grupo -> atributo IPP de %{...}
+        self.regex = self.compile(log_format)
+        # Si el formato no incluye comillas de línea, las que traiga la línea se descartan
+        self.strip_line_quotes = not (log_format.startswith('"') and log_format.endswith('"'))
+    
+    def compile(self, log_format: str):
+        """Convertir el PageLogFormat en una única expresión regular anclada"""
+        tokens = re.split(r'(%%|%[A-Za-z]|%\{[^}]+\})', log_format)
+        pattern = []
+        used = set()
+        
+        for i, token in enumerate(tokens):
+            if not token:
+                continue
+            if token == '%%':
+                pattern.append('%')
+                continue
+            if not token.startswith('%'):
+                pattern.append(re.escape(token))
+                continue
+            
+            if token.startswith('%{'):
+                attribute = token[2:-1]
+                name = 'attr_' + re.sub(r'\W', '_', attribute)
+                # Entre comillas solo si las tiene a ambos lados: la comilla final de un
+                # formato entrecomillado no convierte el último atributo en texto libre
+                previous = tokens[i - 1] if i > 0 else ''
+                following = tokens[i + 1] if i + 1 < len(tokens) else ''
+                quoted = previous.endswith('"') and following.startswith('"')
+                if quoted or attribute in self.FREE_TEXT_ATTRIBUTES:
+                    # Texto libre o entre comillas: lo delimita el resto del formato anclado
+                    field_pattern = r'.*?'
+                else:
+                    field_pattern = r'\S*'
+                self.attributes[name] = attribute
+            elif token[1] in self.DIRECTIVES:
+                name, field_pattern = self.DIRECTIVES[token[1]]
+            else:
+                raise ValueError(f"Directiva desconocida en PageLogFormat: {token}")
+            
+            if name in used:
+                pattern.append(f'(?:{field_pattern})')
+            else:
+                used.add(name)
+                pattern.append(f'(?P<{name}>{field_pattern})')
+        
+        missing = {'printer', 'user', 'job_id'} - used
+        if missing:
+            raise ValueError(f"PageLogFormat sin campos necesarios: {', '.join(sorted(missing))}")
+        
+        return re.compile('^' + ''.join(pattern) + '$')
+    
+    @classmethod
+    def from_config(cls, cupsd_conf: str = CUPSD_CONF):
+        """Crear el parser con PAGE_LOG_FORMAT o, si no está definido, con el de cupsd.conf"""
+        log_format = PAGE_LOG_FORMAT or cls.read_cupsd_format(cupsd_conf) or DEFAULT_PAGE_LOG_FORMAT
+        try:
+            parser = cls(log_format)
+        except (ValueError, re.error) as e:
+            logging.warning(f"PageLogFormat no utilizable ({e}), se usa el formato por defecto de CUPS")
+            parser = cls(DEFAULT_PAGE_LOG_FORMAT)
+        
+        logging.info(f"Formato de page_log: {parser.log_format}")
+        return parser
+    
+    @staticmethod
+    def read_cupsd_format(cupsd_conf: str):
+        """Leer la directiva PageLogFormat de cupsd.conf (None si no está)"""
+        try:
+            with open(cupsd_conf, 'r', errors='ignore') as f:
+                for line in f:
+                    parts = line.strip().split(None, 1)
+                    if len(parts) == 2 and parts[0].lower() == 'pagelogformat':
+                        value = parts[1].strip()
+                        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+                            value = value[1:-1]
+                        return value
+        except OSError as e:
+            logging.warning(f"No se pudo leer {cupsd_conf}: {e}")
+        return None
+    
+    def parse(self, line: str) -> Dict:
+        """Parsear una línea del page_log; None si no corresponde al formato"""
+        line = line.rstrip('\r\n')
+        if self.strip_line_quotes and len(line) >= 2 and line[0] == '"' and line[-1] == '"':
+            line = line[1:-1]
+        
+        match = self.regex.match(line)
+        if not match:
+            return None
+        
+        fields = match.groupdict()
+        job_id = fields['job_id']
+        
+        # "%P %C" es "total <impresiones>" al final del trabajo o "<página> <copias>" por página
+        pages = 1
+        copies = 1
+        page = fields.get('page')
+        try:
+            if page == 'total':
+                pages = int(fields['copies'])
+            elif fields.get('copies'):
+                copies = int(fields['copies'])
+        except ValueError:
+            pass
+        
+        timestamp = None
+        if fields.get('date'):
+            timestamp = parse_cups_date(fields['date'][1:-1])
+        if timestamp is None:
+            # Si falla, usar fecha actual
+            timestamp = datetime.now()
+        
+        document = (fields.get('attr_job_name') or '').strip()
+        if not document or document == '-':
+            document = f"Documento {job_id}"
+        
+        return {
+            'printer': fields['printer'],
+            'user': fields['user'],
+            'job_id': job_id,
+            'pages': pages,
+            'timestamp': timestamp,
+            'document': document,
+            'copies': copies,
+            'status': 'completed',
+            'source': 'page_log',
+            'page_total': page == 'total'
+        }
+
+class PageLogJobAggregator:
+    """Agrupa las líneas de un mismo trabajo (impresora, job_id) del page_log en un único registro"""
+    
+    def __init__(self, window_seconds: int = JOB_COALESCE_WINDOW, max_in_flight: int = MAX_JOBS_IN_FLIGHT):
+        self.window = timedelta(seconds=window_seconds)
+        self.max_in_flight = max_in_flight
+        # (impresora, job_id) -> {'job': datos acumulados, 'last_seen': timestamp, 'offset': byte inicial,
+        #                        'page_sum': impresiones de líneas por página, 'total_sum': impresiones de líneas "total"}
+        self.in_flight = OrderedDict()
+    
+    def add(self, job_data: Dict, offset: int = 0) -> List[Dict]:
+        """Sumar una línea parseada; devuelve los trabajos que quedaron completos"""
+        timestamp = job_data['timestamp']
+        key = (job_data['printer'], job_data['job_id'])
+        
+        # Un trabajo está completo si otro trabajo empezó en su impresora
+        # o si no recibió líneas dentro de la ventana
+        completed = []
+        for other_key, entry in list(self.in_flight.items()):
+            if other_key == key:
+                continue
+            if other_key[0] == key[0] or timestamp - entry['last_seen'] > self.window:
+                completed.append(self.in_flight.pop(other_key))
+        
+        entry = self.in_flight.get(key)
+        if entry is None:
+            entry = {'job': dict(job_data), 'last_seen': timestamp, 'offset': offset,
+                     'page_sum': 0, 'total_sum': None}
+            self.in_flight[key] = entry
+        else:
+            entry['job']['copies'] = max(entry['job']['copies'], job_data['copies'])
+            entry['last_seen'] = max(entry['last_seen'], timestamp)
+        
+        # Se cuentan impresiones (copias incluidas), igual que el contador de CUPS:
+        # la línea "total N" es el conteo final y reemplaza la suma de las líneas por página
+        if job_data.get('page_total'):
+            entry['total_sum'] = (entry['total_sum'] or 0) + job_data['pages']
+        else:
+            entry['page_sum'] += job_data['pages'] * job_data['copies']
+        entry['job']['pages'] = entry['total_sum'] if entry['total_sum'] is not None else entry['page_sum']
+        
+        if len(self.in_flight) > self.max_in_flight:
+            completed.append(self.in_flight.popitem(last=False)[1])
+        
+        return completed
+    
+    def flush(self, now: datetime = None) -> List[Dict]:
+        """Cerrar los trabajos sin líneas nuevas dentro de la ventana (todos si now es None)"""
+        completed = []
+        for key, entry in list(self.in_flight.items()):
+            if now is None or now - entry['last_seen'] > self.window:
+                completed.append(self.in_flight.pop(key))
+        return completed
+    
+    def pending_offset(self):
+        """Offset de la primera línea del trabajo abierto más antiguo, o None"""
+        if not self.in_flight:
+            return None
+        return min(entry['offset'] for entry in self.in_flight.values())
+
+class DocumentCache:
+    """Caché persistente (LRU) de documentos del spool indexada por huella de contenido"""
+    
+    def __init__(self, path: str = DOCUMENT_CACHE_FILE, max_entries: int = DOCUMENT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # huella -> {'pages', 'format', 'title'}, la más reciente al final
+        self.jobs = OrderedDict()  # job_id -> huella de su documento (trabajos ya analizados)
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+    
+    @staticmethod
+    def fingerprint(data_file: str) -> str:
+        """Huella rápida: tamaño + primer y último bloque del archivo"""
+        with open(data_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+            digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+            if size > FINGERPRINT_BLOCK_SIZE:
+                f.seek(max(size - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+                digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        return digest.hexdigest()
+    
+    def load(self):
+        """Leer la caché guardada; si falta o está corrupta se empieza vacía"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            # Formato anterior: solo la lista de documentos
+            if isinstance(data, list):
+                data = {'documents': data}
+            self.entries = OrderedDict(data.get('documents', []))
+            self.jobs = OrderedDict(data.get('jobs', []))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning(f"Caché de documentos inválida, se descarta: {e}")
+    
+    def save(self):
+        """Guardar la caché de forma atómica si cambió"""
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'documents': list(self.entries.items()), 'jobs': list(self.jobs.items())}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            logging.warning(f"No se pudo guardar la caché de documentos: {e}")
+    
+    def get(self, key: str):
+        """Buscar una huella y marcarla como usada recientemente"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        # El nuevo orden solo se guarda junto con el próximo cambio: reescribir
+        # el archivo en cada ejecución del timer por un acierto no vale la pena
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+    
+    def put(self, key: str, entry: Dict):
+        """Guardar el análisis de un documento descartando el menos usado si hace falta"""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+    
+    def get_job(self, job_id: str):
+        """Análisis de un trabajo ya visto en otra ejecución, sin volver a leer su archivo (no cuenta como consulta)"""
+        key = self.jobs.get(job_id)
+        return self.entries.get(key) if key else None
+    
+    def put_job(self, job_id: str, key: str):
+        """Recordar qué documento tiene un trabajo; se descartan los trabajos más viejos"""
+        if self.jobs.get(job_id) == key:
+            return
+        self.jobs[job_id] = key
+        while len(self.jobs) > self.max_entries:
+            self.jobs.popitem(last=False)
+        self.dirty = True
+    
+    def stats(self) -> str:
+        """Resumen de aciertos para las estadísticas de la ejecución"""
+        lookups = self.hits + self.misses
+        rate = (self.hits * 100 / lookups) if lookups else 0
+        return f"{self.hits} aciertos de {lookups} consultas ({rate:.0f}%), {len(self.entries)} documentos"
+
 class CUPSLogProcessor:
     def __init__(self, db: PrintServerDB):
         self.db = db
         self.processed_jobs = self.db.get_processed_jobs()
         self.control_parser = CUPSControlFileParser()
+        self.log_format = PageLogFormatParser.from_config()
+        self.document_cache = DocumentCache()
+        self.insert_failures = {}  # job_id -> ejecuciones en que falló su inserción (se guarda en el checkpoint)
 
     def parse_journal_line(self, line: str) -> Dict:
         """Parsear una línea del journal de CUPS"""
@@ -412,7 +985,8 @@ class CUPSLogProcessor:
                 'timestamp': timestamp,
                 'document': document,
                 'copies': 1,
-                'status': 'completed'
+                'status': 'completed',
+                'source': 'journal'
             }
             
         except Exception as e:
@@ -420,102 +994,77 @@ class CUPSLogProcessor:
             return None
 
     def parse_log_line(self, line: str) -> Dict:
-        """Parsear una línea del log de CUPS (legacy) - formato real de CUPS"""
-        try:
-            # Quitar comillas al inicio y fin
-            line = line.strip().strip('"')
-            parts = line.split()
-            
-            if len(parts) < 6:
-                return None
-            
-            printer = parts[0]  # %p - nombre de la impresora
-            user = parts[1]     # %u - usuario
-            job_id = parts[2]   # %j - job-id
-            
-            # Extraer fecha y hora del formato [27/Aug/2025:13:30:28 -0300]
-            # La fecha puede estar en una o dos partes dependiendo de si hay zona horaria
-            date_time_part = parts[3].strip("[]")
-            if len(parts) > 4 and (parts[4].startswith("-") or parts[4].startswith("+")):
-                # Hay zona horaria separada, combinar fecha y zona
-                date_time_str = date_time_part + " " + parts[4]
-                # Saltar la zona horaria en el siguiente procesamiento
-                timezone_offset = 1
-            else:
-                # No hay zona horaria separada
-                date_time_str = date_time_part
-                timezone_offset = 0
-            
-            # Extraer páginas del formato "total 1" - está después de la fecha
-            pages = 1  # Por defecto
-            total_pos = 4 + timezone_offset
-            if len(parts) > total_pos and parts[total_pos] == "total":
-                try:
-                    pages = int(parts[total_pos + 1])
-                    logging.info(f"Páginas extraídas del log: {pages}")
-                except (ValueError, IndexError):
-                    pages = 1
-                    logging.warning(f"No se pudo parsear páginas del formato 'total X', usando valor por defecto: {pages}")
-            
-            # Extraer nombre del documento - está después de "total X -"
-            document = f"Documento {job_id}"  
-            doc_pos = total_pos + 3  
-            if len(parts) > doc_pos:
-                # El nombre del documento está después de la IP del cliente
-                doc_parts = []
-                i = doc_pos
-                
-                # Recopilar el nombre del documento hasta encontrar "one-sided" o el final
-                while i < len(parts) and parts[i] not in ["one-sided", "two-sided"]:
-                    doc_parts.append(parts[i])
-                    i += 1
-                
-                if doc_parts:
-                    
-                    filtered_parts = []
-                    for part in doc_parts:
+        """Parsear una línea del log de CUPS (legacy) con el PageLogFormat configurado"""
+        return self.log_format.parse(line)
 
-                        if not re.match(r'^\d+\.\d+\.\d+\.\d+$', part):
-                            filtered_parts.append(part)
-                    
-                    if filtered_parts:
-                        document = " ".join(filtered_parts)
-                        logging.info(f"Nombre del documento extraído (sin IP): '{document}'")
-                    else:
-                        # Si solo quedó la IP, usar nombre por defecto
-                        document = f"Documento {job_id}"
-                        logging.info(f"Usando nombre por defecto (solo IP encontrada): {document}")
-                else:
-                    # Si no se pudo extraer, usar "Documento N"
-                    document = f"Documento {job_id}"
-                    logging.info(f"Usando nombre por defecto: {document}")
-            
-            copies = 1
-            
-            # Parsear fecha
-            try:
-                timestamp = datetime.strptime(date_time_str, "%d/%b/%Y:%H:%M:%S")
-                # Ajustar año si es necesario
-                if timestamp.year == 1900:
-                    timestamp = timestamp.replace(year=datetime.now().year)
-            except ValueError:
-                # Si falla, usar fecha actual
-                timestamp = datetime.now()
-            
-            return {
-                'printer': printer,
-                'user': user,
-                'job_id': job_id,
-                'pages': pages,
-                'timestamp': timestamp,
-                'document': document,
-                'copies': copies,
-                'status': 'completed'
-            }
-            
-        except (ValueError, IndexError) as e:
-            logging.warning(f"Error parseando línea: {line[:50]}... - {e}")
+    def record_job(self, job_data: Dict):
+        """Insertar un trabajo completo en la BD y marcarlo como procesado (None si otro proceso ya lo registró)"""
+        inserted = self.db.insert_print_job(job_data)
+        if inserted is False:
+            return False
+        
+        self.processed_jobs.add(job_data['job_id'])
+        if inserted is None:
+            logging.info(f"Trabajo {job_data['job_id']} omitido: ya estaba registrado")
             return None
+        
+        logging.info(f"Trabajo {job_data['job_id']} insertado: {job_data['user']} -> {job_data['printer']} ({job_data['pages']} páginas, {job_data['copies']} copias) - '{job_data['document']}'")
+        return True
+
+    def parse_notification(self, event: Dict) -> Dict:
+        """Convertir un evento del notificador de CUPS en datos de trabajo (None si no terminó)"""
+        status = JOB_STATE_STATUS.get(event.get('job-state'))
+        if status is None or event.get('notify-job-id') is None:
+            return None
+        
+        job_id = str(event['notify-job-id'])
+        
+        printer = event.get('printer-name')
+        if not printer:
+            # Tomar el nombre desde ipp://servidor/printers/NOMBRE
+            printer = str(event.get('notify-printer-uri', '')).rstrip('/').rsplit('/', 1)[-1]
+        if not printer:
+            logging.warning(f"Evento del trabajo {job_id} sin impresora, se descarta")
+            return None
+        
+        # CUPS no siempre incluye el usuario en el evento: completarlo con el archivo de control
+        job_info = {}
+        control_file = os.path.join(CUPS_SPOOL_DIR, f"c{job_id.zfill(5)}")
+        if os.path.exists(control_file):
+            job_info = self.control_parser.extract_job_info(control_file)
+        
+        user = event.get('job-originating-user-name') or job_info.get('user') or "desconocido"
+        document = event.get('job-name') or job_info.get('document_name') or f"Documento {job_id}"
+        # job-impressions-completed cuenta impresiones (copias incluidas), no páginas del documento.
+        # CUPS lo toma del mismo contador que escribe como "total N" en el page_log, por eso se
+        # guarda sin convertir: coincide con las páginas que registra la lectura del page_log.
+        # Un trabajo cancelado o abortado antes de imprimir queda con 0, no con 1
+        pages = event.get('job-impressions-completed') or 0
+        copies = job_info.get('copies', 1)
+        
+        return {
+            'printer': printer,
+            'user': user,
+            'job_id': job_id,
+            'pages': pages,
+            'timestamp': datetime.now(),
+            'document': document,
+            'copies': copies,
+            'status': status,
+            'source': 'notifier'
+        }
+
+    def ingest_notification(self, event: Dict):
+        """Registrar en la BD el trabajo de un evento del notificador de CUPS (igual que record_job)"""
+        job_data = self.parse_notification(event)
+        if not job_data:
+            return False
+        
+        # job-completed y job-state-changed llegan ambos al terminar el trabajo
+        if job_data['job_id'] in self.processed_jobs:
+            return False
+        
+        return self.record_job(job_data)
 
     def wait_for_control_files(self, job_id: str, max_wait_seconds: int = 30) -> bool:
         """Esperar a que el archivo de control esté disponible para un trabajo específico"""
@@ -594,6 +1143,14 @@ class CUPSLogProcessor:
                         # Si no hay nombre del documento, usar "Documento N"
                         document_name = job_info.get('document_name')
                         if not document_name or document_name == '%N':
+                            # Probar con el título del propio documento (caché por huella)
+                            try:
+                                info = self.get_document_info(job_id)
+                            except Exception as e:
+                                logging.debug(f"Error analizando documento del trabajo {job_id}: {e}")
+                                info = None
+                            document_name = info.get('title') if info else None
+                        if not document_name:
                             document_name = f"Documento {job_id}"
                             logging.info(f"Usando nombre por defecto para trabajo {job_id}: {document_name}")
                         
@@ -625,34 +1182,66 @@ class CUPSLogProcessor:
         except Exception as e:
             logging.error(f"Error procesando archivos de control de CUPS: {e}")
 
+    def analyze_data_file(self, data_file: str) -> Dict:
+        """Detectar formato, páginas y título de un archivo de datos del spool (file + pdfinfo)"""
+        info = {'pages': None, 'format': None, 'title': None}
+        
+        result = subprocess.run(['file', '-b', data_file], capture_output=True, text=True, timeout=10)
+        if result.returncode == 0:
+            info['format'] = result.stdout.strip()
+        
+        # Si es un PDF, usar pdfinfo para contar páginas
+        if info['format'] and 'PDF' in info['format']:
+            result = subprocess.run(['pdfinfo', data_file], capture_output=True, text=True, timeout=10)
+            if result.returncode == 0:
+                # Buscar las líneas "Pages: X" y "Title: Y"
+                for line in result.stdout.split('\n'):
+                    if line.startswith('Pages:'):
+                        try:
+                            info['pages'] = int(line.split(':', 1)[1].strip())
+                        except ValueError:
+                            continue
+                    elif line.startswith('Title:'):
+                        title = self.control_parser.normalize_document_name(line.split(':', 1)[1])
+                        if len(title) > 2:
+                            info['title'] = title
+        
+        return info
+
+    def get_document_info(self, job_id: str) -> Dict:
+        """Obtener páginas/formato/título del documento de un trabajo, usando la caché por huella"""
+        # Los trabajos retenidos siguen en el spool: no releerlos en cada ejecución
+        info = self.document_cache.get_job(job_id)
+        if info is not None:
+            return info
+        
+        # CUPS nombra los archivos de datos d<job-id de 5 dígitos>-<número de documento>
+        data_files = glob.glob(f"{CUPS_SPOOL_DIR}/d{job_id.zfill(5)}-*")
+        
+        if not data_files:
+            logging.debug(f"No se encontraron archivos de datos para job {job_id}")
+            return None
+        
+        # Probar con el primer archivo de datos
+        data_file = sorted(data_files)[0]
+        
+        key = self.document_cache.fingerprint(data_file)
+        info = self.document_cache.get(key)
+        if info is None:
+            info = self.analyze_data_file(data_file)
+            self.document_cache.put(key, info)
+        self.document_cache.put_job(job_id, key)
+        
+        return info
+
     def get_real_page_count(self, document_name: str, job_id: str) -> int:
         """Intentar obtener el número real de páginas usando pdfinfo"""
         try:
-
-            data_files = glob.glob(f"{CUPS_SPOOL_DIR}/d{job_id.zfill(6)}-*")
-            
-            if not data_files:
-                logging.debug(f"No se encontraron archivos de datos para job {job_id}")
-                return None
+            info = self.get_document_info(job_id)
             
-            # Probar con el primer archivo de datos
-            data_file = data_files[0]
-            
-            # Verificar si es un PDF
-            result = subprocess.run(['file', data_file], capture_output=True, text=True, timeout=10)
-            if result.returncode == 0 and 'PDF' in result.stdout:
-                # Es un PDF, usar pdfinfo para contar páginas
-                result = subprocess.run(['pdfinfo', data_file], capture_output=True, text=True, timeout=10)
-                if result.returncode == 0:
-                    # Buscar la línea "Pages: X"
-                    for line in result.stdout.split('\n'):
-                        if line.startswith('Pages:'):
-                            try:
-                                page_count = int(line.split(':')[1].strip())
-                                logging.info(f"Páginas reales detectadas por pdfinfo: {page_count}")
-                                return page_count
-                            except (ValueError, IndexError):
-                                continue
+            if info and info.get('pages'):
+                logging.info(f"Páginas reales detectadas por pdfinfo: {info['pages']}")
+                return info['pages']
             
             logging.debug(f"No se pudo obtener número real de páginas para {document_name}")
             return None
@@ -661,6 +1250,11 @@ class CUPSLogProcessor:
             logging.debug(f"Error obteniendo páginas reales: {e}")
             return None
 
+    def save_document_cache(self):
+        """Guardar la caché de documentos y mostrar su tasa de aciertos"""
+        logging.info(f"Caché de documentos: {self.document_cache.stats()}")
+        self.document_cache.save()
+
     def process_journal(self):
         """Procesar logs desde el journal de systemd - SOLUCIÓN DEFINITIVA"""
         logging.info("Procesando logs desde journal de CUPS...")
@@ -690,8 +1284,10 @@ class CUPSLogProcessor:
                 # Verificar si ya fue procesado
                 if job_data['job_id'] not in self.processed_jobs:
                     # Insertar trabajo inmediatamente
-                    if self.db.insert_print_job(job_data):
+                    inserted = self.db.insert_print_job(job_data)
+                    if inserted is not False:
                         self.processed_jobs.add(job_data['job_id'])
+                    if inserted:
                         nuevos_trabajos += 1
                         logging.info(f"Trabajo {job_data['job_id']} insertado desde journal: {job_data['user']} -> {job_data['printer']} ({job_data['pages']} páginas)")
                     
@@ -710,8 +1306,129 @@ class CUPSLogProcessor:
         except Exception as e:
             logging.error(f"Error procesando journal: {e}")
 
+    @staticmethod
+    def parse_line_timestamp(line: bytes):
+        """Extraer el timestamp [dd/Mon/aaaa:HH:MM:SS zona] de una línea cruda del page_log"""
+        start = line.find(b'[')
+        end = line.find(b']', start + 1)
+        if start == -1 or end == -1:
+            return None
+        
+        return parse_cups_date(line[start + 1:end].decode('ascii', errors='ignore'))
+
+    def find_resume_offset(self, log_file_path: str, since: datetime) -> int:
+        """Buscar por bisección (vía mmap) el offset de la primera línea con timestamp >= since"""
+        with open(log_file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return 0
+            
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Invariante: lo es inicio de línea, las líneas antes de lo son anteriores
+                # a since y las que empiezan en hi o después son posteriores
+                lo, hi = 0, size
+                probes = 0
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    probes += 1
+                    
+                    # Alinear la sonda al comienzo de la línea siguiente
+                    if mid == 0:
+                        line_start = 0
+                    else:
+                        newline = mm.find(b'\n', mid - 1, hi)
+                        line_start = hi if newline == -1 else newline + 1
+                    
+                    if line_start >= hi:
+                        # No hay comienzos de línea entre mid y hi
+                        hi = mid
+                        continue
+                    
+                    line_end = mm.find(b'\n', line_start)
+                    if line_end == -1:
+                        # Línea incompleta: CUPS todavía la está escribiendo, no saltearla
+                        hi = line_start
+                        continue
+                    
+                    timestamp = self.parse_line_timestamp(mm[line_start:line_end])
+                    if timestamp is None or timestamp < since:
+                        lo = line_end + 1
+                    else:
+                        hi = line_start
+                
+                logging.info(f"Punto de reanudación encontrado en byte {lo} de {size} ({probes} lecturas)")
+                return lo
+
+    def load_checkpoint(self, log_file_path: str):
+        """Leer el offset guardado del page_log; None si falta, está corrupto o el archivo rotó"""
+        try:
+            with open(CHECKPOINT_FILE, 'r') as f:
+                checkpoint = json.load(f)
+            
+            stat = os.stat(log_file_path)
+            offset = int(checkpoint['offset'])
+            if checkpoint.get('inode') != stat.st_ino or not 0 <= offset <= stat.st_size:
+                logging.info("Checkpoint de page_log no corresponde al archivo actual (¿rotación?)")
+                return None
+            
+            # El offset tiene que caer justo después de un salto de línea
+            if offset > 0:
+                with open(log_file_path, 'rb') as f:
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':
+                        logging.warning("Checkpoint de page_log no está alineado a una línea")
+                        return None
+            
+            self.insert_failures = {str(k): int(v) for k, v in checkpoint.get('failures', {}).items()}
+            return offset
+            
+        except FileNotFoundError:
+            logging.info(f"No existe checkpoint de page_log: {CHECKPOINT_FILE}")
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Checkpoint de page_log inválido: {e}")
+            return None
+
+    def save_checkpoint(self, log_file_path: str, offset: int, failures: Dict = None):
+        """Guardar el offset procesado del page_log (y los trabajos que no se pudieron insertar) de forma atómica"""
+        try:
+            os.makedirs(os.path.dirname(CHECKPOINT_FILE), exist_ok=True)
+            tmp_path = CHECKPOINT_FILE + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'path': log_file_path,
+                    'inode': os.stat(log_file_path).st_ino,
+                    'offset': offset,
+                    'failures': failures or {}
+                }, f)
+            os.replace(tmp_path, CHECKPOINT_FILE)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar checkpoint de page_log: {e}")
+
+    def get_resume_offset(self, log_file_path: str) -> int:
+        """Obtener desde dónde leer el page_log: checkpoint o, si se perdió, la BD"""
+        offset = self.load_checkpoint(log_file_path)
+        if offset is not None:
+            return offset
+        
+        # Sin checkpoint: reanudar desde el último trabajo leído del page_log. Se usa el máximo
+        # global porque el page_log es una única fuente ordenada por tiempo para todas las impresoras;
+        # los trabajos del notificador no cuentan (uno que no le llegó quedaría antes de ese máximo).
+        # Se incluyen las líneas con el mismo segundo; processed_jobs descarta repetidos.
+        last_timestamp = self.db.get_last_job_timestamp()
+        if last_timestamp is None:
+            logging.info("Sin trabajos registrados, se procesa el page_log completo")
+            return 0
+        
+        logging.info(f"Recuperando punto de reanudación posterior a {last_timestamp}...")
+        try:
+            return self.find_resume_offset(log_file_path, last_timestamp)
+        except (OSError, ValueError) as e:
+            logging.warning(f"No se pudo buscar el punto de reanudación, se procesa completo: {e}")
+            return 0
+
     def process_log_file(self, log_file_path: str):
-        """Procesar archivo de log completo - SOLUCIÓN DEFINITIVA CON page_log"""
+        """Procesar el page_log desde el último punto procesado - SOLUCIÓN DEFINITIVA CON page_log"""
         # PRIMERO procesar desde page_log (más confiable para páginas)
         if not os.path.exists(log_file_path):
             logging.error(f"Archivo de log page_log no encontrado: {log_file_path}")
@@ -719,46 +1436,42 @@ class CUPSLogProcessor:
         
         logging.info("Procesando logs desde page_log de CUPS...")
         nuevos_trabajos = 0
+        trabajos_omitidos = 0
         
         try:
-            with open(log_file_path, 'r') as file:
-                for line_num, line in enumerate(file, 1):
-                    line = line.strip()
-                    if not line:
+            start_offset = self.get_resume_offset(log_file_path)
+            offset = start_offset
+            resume_offset = None
+            failed_entries = []
+            aggregator = PageLogJobAggregator()
+            
+            def record_completed(entries):
+                nonlocal nuevos_trabajos, trabajos_omitidos
+                for entry in entries:
+                    job_data = entry['job']
+                    # Verificar si ya fue procesado
+                    if job_data['job_id'] in self.processed_jobs:
                         continue
+                    recorded = self.record_job(job_data)
+                    if recorded:
+                        nuevos_trabajos += 1
+                    elif recorded is None:
+                        # Ya lo había registrado el notificador u otra ejecución
+                        trabajos_omitidos += 1
+                    else:
+                        failed_entries.append(entry)
+            
+            with open(log_file_path, 'rb') as file:
+                file.seek(start_offset)
+                for line_num, raw_line in enumerate(file, 1):
+                    if not raw_line.endswith(b'\n'):
+                        # Línea incompleta: se procesa en la próxima ejecución
+                        break
                     
-                    job_data = self.parse_log_line(line)
-                    if not job_data:
-                        continue
+                    line_offset = offset
+                    offset += len(raw_line)
                     
-                    # Verificar si ya fue procesado
-                    if job_data['job_id'] not in self.processed_jobs:
-                        # Insertar trabajo inmediatamente con la información extraída
-                        if self.db.insert_print_job(job_data):
-                            self.processed_jobs.add(job_data['job_id'])
-                            nuevos_trabajos += 1
-                            logging.info(f"Trabajo {job_data['job_id']} insertado: {job_data['user']} -> {job_data['printer']} ({job_data['pages']} páginas) - '{job_data['document']}'")
-                        
-                        # Mostrar progreso cada 1000 líneas
-                        if line_num % 1000 == 0:
-                            logging.info(f"Procesadas {line_num} líneas...")
-                
-                logging.info(f"Procesamiento completado: {nuevos_trabajos} trabajos nuevos agregados")
-            
-            # SIEMPRE procesar archivos de control para obtener información más precisa
-            # Esto incluye trabajos existentes y nuevos
-            logging.info("Procesando archivos de control para obtener información más precisa...")
-            self.process_cups_control_files()
-                
-        except Exception as e:
-            logging.error(f"Error procesando archivo de log: {e}")
-        
-        nuevos_trabajos = 0
-        
-        try:
-            with open(log_file_path, 'r') as file:
-                for line_num, line in enumerate(file, 1):
-                    line = line.strip()
+                    line = raw_line.decode('utf-8', errors='ignore').strip()
                     if not line:
                         continue
                     
@@ -766,20 +1479,39 @@ class CUPSLogProcessor:
                     if not job_data:
                         continue
                     
-                    # Verificar si ya fue procesado
-                    if job_data['job_id'] not in self.processed_jobs:
-                        # Insertar trabajo inmediatamente con la información extraída
-                        if self.db.insert_print_job(job_data):
-                            self.processed_jobs.add(job_data['job_id'])
-                            nuevos_trabajos += 1
-                            logging.info(f"Trabajo {job_data['job_id']} insertado: {job_data['user']} -> {job_data['printer']} ({job_data['pages']} páginas) - '{job_data['document']}'")
-                        
-                        # Mostrar progreso cada 1000 líneas
-                        if line_num % 1000 == 0:
-                            logging.info(f"Procesadas {line_num} líneas...")
+                    # Las líneas de un mismo trabajo se suman antes de insertar
+                    record_completed(aggregator.add(job_data, line_offset))
+                    
+                    # Mostrar progreso cada 1000 líneas
+                    if line_num % 1000 == 0:
+                        logging.info(f"Procesadas {line_num} líneas...")
                 
-                logging.info(f"Procesamiento completado: {nuevos_trabajos} trabajos nuevos agregados")
+                # Los trabajos que todavía pueden recibir líneas se releen en la próxima ejecución
+                record_completed(aggregator.flush(datetime.now()))
+                pending_offset = aggregator.pending_offset()
+                if pending_offset is not None:
+                    logging.info(f"{len(aggregator.in_flight)} trabajos en curso quedan para la próxima ejecución")
+                
+                logging.info(f"Procesamiento completado: {nuevos_trabajos} trabajos nuevos agregados, {trabajos_omitidos} ya registrados ({offset - start_offset} bytes leídos)")
+            
+            # No avanzar el checkpoint más allá de un trabajo sin guardar, salvo que falle
+            # siempre mientras otros se insertan bien (ej.: un dato inválido): ahí se descarta.
+            # Si no se guardó ninguno (BD caída) el intento no se cuenta.
+            failures = {}
+            for entry in failed_entries:
+                job_id = entry['job']['job_id']
+                attempts = self.insert_failures.get(job_id, 0) + (1 if nuevos_trabajos or trabajos_omitidos else 0)
+                if attempts >= MAX_JOB_INSERT_ATTEMPTS:
+                    logging.error(f"Trabajo {job_id} descartado tras {attempts} ejecuciones sin poder insertarlo")
+                    continue
+                failures[job_id] = attempts
+                if resume_offset is None or entry['offset'] < resume_offset:
+                    resume_offset = entry['offset']
             
+            checkpoint_offset = min(o for o in (offset, resume_offset, pending_offset) if o is not None)
+            self.save_checkpoint(log_file_path, checkpoint_offset, failures)
+            
+            # SIEMPRE procesar archivos de control para obtener información más precisa
             # Esto incluye trabajos existentes y nuevos
             logging.info("Procesando archivos de control para obtener información más precisa...")
             self.process_cups_control_files()
@@ -789,8 +1521,99 @@ class CUPSLogProcessor:
 
 
 
+def verify_schema(db: PrintServerDB) -> bool:
+    """Verificar que las migraciones del esquema ya se aplicaron"""
+    # Sin la migración se guardaría el id numérico como nombre de usuario
+    if not db.user_keys_migrated():
+        logging.error("print_jobs.user_id todavía es texto")
+        logging.error("   SOLUCIÓN: Ejecutar: python3 procesar_logs.py --migrate-users")
+        return False
+    
+    # Sin índice único el timer y el modo residente podrían registrar dos veces el mismo trabajo
+    if not db.job_ids_unique():
+        logging.error("print_jobs.job_id todavía no es único")
+        logging.error("   SOLUCIÓN: Ejecutar: python3 procesar_logs.py --migrate-job-ids")
+        return False
+    
+    # Sin el origen la reanudación sin checkpoint no distingue las filas del notificador
+    if not db.job_source_tracked():
+        logging.error("print_jobs todavía no tiene la columna source")
+        logging.error("   SOLUCIÓN: Ejecutar: python3 procesar_logs.py --migrate-job-source")
+        return False
+    
+    return True
+
+
+def schema_checked(config: Dict) -> bool:
+    """Verificar si el esquema de esta base de datos ya se comprobó en una ejecución anterior"""
+    try:
+        with open(SCHEMA_CHECK_FILE, 'r') as f:
+            checked = json.load(f)
+        return checked == {'host': config['host'], 'database': config['database']}
+    except (OSError, ValueError):
+        return False
+
+
+def save_schema_checked(config: Dict):
+    """Recordar que el esquema está al día para no consultar information_schema en cada ejecución"""
+    try:
+        os.makedirs(os.path.dirname(SCHEMA_CHECK_FILE), exist_ok=True)
+        tmp_path = SCHEMA_CHECK_FILE + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'host': config['host'], 'database': config['database']}, f)
+        os.replace(tmp_path, SCHEMA_CHECK_FILE)
+    except OSError as e:
+        logging.warning(f"No se pudo guardar la verificación del esquema: {e}")
+
+
+def run_notification_daemon(processor: CUPSLogProcessor, socket_path: str):
+    """Recibir los eventos de notificador_cups.py por el socket Unix y registrarlos en la BD"""
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(socket_path)
+    
+    # El notificador corre dentro de cupsd con el usuario lp
+    try:
+        os.chown(socket_path, -1, grp.getgrnam(NOTIFY_SOCKET_GROUP).gr_gid)
+        os.chmod(socket_path, 0o660)
+    except (KeyError, OSError) as e:
+        logging.warning(f"No se pudo dar acceso al grupo {NOTIFY_SOCKET_GROUP} sobre {socket_path}: {e}")
+        logging.warning("   SOLUCIÓN: Agregar usuario al grupo lp: sudo usermod -a -G lp $USER")
+    
+    logging.info(f"Esperando eventos de CUPS en {socket_path}...")
+    
+    try:
+        while True:
+            data = sock.recv(NOTIFY_MAX_EVENT_SIZE)
+            try:
+                event = json.loads(data.decode('utf-8'))
+            except ValueError as e:
+                logging.warning(f"Evento inválido recibido del notificador: {e}")
+                continue
+            
+            processor.ingest_notification(event)
+    finally:
+        sock.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
 def main():
-    """Función principal - Procesa logs una sola vez"""
+    """Función principal - Procesa logs una sola vez o recibe eventos en modo residente"""
+    parser = argparse.ArgumentParser(description="Procesador de logs de CUPS para el Print Server")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Registrar trabajos a medida que llegan eventos del notificador de CUPS")
+    parser.add_argument('--migrate-users', action='store_true',
+                        help="Convertir print_jobs.user_id a la clave entera de la tabla users y salir")
+    parser.add_argument('--migrate-job-ids', action='store_true',
+                        help="Eliminar trabajos repetidos, hacer único print_jobs.job_id y salir")
+    parser.add_argument('--migrate-job-source', action='store_true',
+                        help="Agregar a print_jobs la columna source (origen del registro) y salir")
+    args = parser.parse_args()
+    
     logging.info("Iniciando procesamiento de logs de CUPS")
     
     # Inicializar base de datos
@@ -800,13 +1623,33 @@ def main():
         logging.error(f"No se pudo conectar a la base de datos: {e}")
         sys.exit(1)
     
+    if args.migrate_users:
+        sys.exit(0 if db.migrate_user_keys() else 1)
+    
+    if args.migrate_job_ids:
+        sys.exit(0 if db.migrate_unique_job_ids() else 1)
+    
+    if args.migrate_job_source:
+        sys.exit(0 if db.migrate_job_source() else 1)
+    
+    # El timer corre cada 20 segundos: el esquema se verifica una sola vez por base de datos
+    if not schema_checked(DB_CONFIG):
+        if not verify_schema(db):
+            sys.exit(1)
+        save_schema_checked(DB_CONFIG)
+    
     # Inicializar procesador
     processor = CUPSLogProcessor(db)
     
+    if args.daemon:
+        run_notification_daemon(processor, NOTIFY_SOCKET)
+        return
+    
     # Procesar logs desde archivo legacy
     if os.path.exists(LOG_FILE):
         logging.info(f"Procesando archivo: {LOG_FILE}")
         processor.process_log_file(LOG_FILE)
+        processor.save_document_cache()
     else:
         logging.error(f"No se encontró archivo de log: {LOG_FILE}")
         logging.error("Verificar que CUPS esté configurado para generar page_log")
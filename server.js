@@ -125,15 +125,23 @@ app.get('/api/top-users', async (req, res) => {
     const params = date ? [date] : [];
     
     // Obtener top 5 usuarios por páginas impresas en el día seleccionado
+    // (se agrupa por la clave entera y solo se buscan los nombres de los 5 primeros)
     const [users] = await connection.execute(`
       SELECT 
-        user_id,
-        SUM(pages) as total_pages_today
-      FROM print_jobs 
-      WHERE ${dateCondition}
-      GROUP BY user_id
-      ORDER BY total_pages_today DESC
-      LIMIT 5
+        u.username as user_id,
+        top.total_pages_today
+      FROM (
+        SELECT 
+          user_id,
+          SUM(pages) as total_pages_today
+        FROM print_jobs 
+        WHERE ${dateCondition}
+        GROUP BY user_id
+        ORDER BY total_pages_today DESC
+        LIMIT 5
+      ) top
+      JOIN users u ON top.user_id = u.id
+      ORDER BY top.total_pages_today DESC
     `, params);
     
     connection.release();
@@ -241,7 +249,7 @@ app.get('/api/print-jobs', async (req, res) => {
     let query = `
       SELECT 
         pj.job_id,
-        pj.user_id,
+        u.username as user_id,
         p.name as printer_name,
         pj.document_name,
         pj.pages,
@@ -250,13 +258,14 @@ app.get('/api/print-jobs', async (req, res) => {
         pj.timestamp
       FROM print_jobs pj
       JOIN printers p ON pj.printer_id = p.id
+      JOIN users u ON pj.user_id = u.id
       WHERE 1=1
     `;
     
     const params = [];
     
     if (user && user.trim() !== '') {
-      query += ' AND pj.user_id LIKE ?';
+      query += ' AND u.username LIKE ?';
       params.push(`%${user.trim()}%`);
     }
     